@@ -7,18 +7,44 @@
 
 # Import required packages
 import argparse
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
 from pathlib import Path
+import hashlib
 import os
+import re
+import tempfile
 import nibabel as nib
 import numpy as np
 import pydicom
-import matplotlib.pyplot as plt
+
+# Import dicomsdl (optional, used to modify and save DICOM files more quickly)
+try:
+    import dicomsdl
+    HAVE_DICOMSDL = True
+except ImportError:
+    HAVE_DICOMSDL = False
+
+# Specify number of slices and shape of each slice (i.e. 2D image) of the image
+# and GT segmentations (the conversion is specific to volumes of this shape)
+NUM_SLICES = 272
+SLICE_SHAPE = (512, 512)
+VOLUME_SHAPE = (NUM_SLICES, *SLICE_SHAPE)
+
+# Specify number of bytes in the PixelData field of each DICOM file (int16 pixels)
+SLICE_NBYTES = SLICE_SHAPE[0] * SLICE_SHAPE[1] * np.dtype(np.int16).itemsize
+
+def natural_sort_key(file_name):
+
+    # Split file name into text and numbers so that, for example, 
+    # "IM-2.dcm" is placed before "IM-10.dcm"
+    return [int(g) if g.isdigit() else g for g in re.split(r'(\d+)', file_name)]
 
 def list_files_in_dir(dir_path):
     
-    # Create list of files in folder
-    file_list = [g for g in os.listdir(dir_path) if (g.endswith('dcm') and g.startswith('IM-'))]
-    file_list.sort()
+    # Create list of paths to files in folder with names matching "IM-*.dcm" 
+    # (excluding folders with names matching this pattern)
+    file_list = sorted((g for g in Path(dir_path).glob('IM-*.dcm') if g.is_file()), key=lambda g: natural_sort_key(g.name))
 
     # Check list is not empty
     assert file_list, f'There are no ".dcm" files in "{dir_path}".'
@@ -26,102 +52,295 @@ def list_files_in_dir(dir_path):
     # Return list
     return file_list
 
-def main(seg_path, nii_img_path, dcm_dir_path, save_dir_path):
+def orient_volume(volume, out=None):
 
-    # Create list of DICOM files in "dcm_dir_path"
-    dcm_list = list_files_in_dir(dcm_dir_path)
+    # Create int16 output array (if not provided)
+    if out is None:
+        out = np.empty(volume.shape, dtype=np.int16)
 
-    # Check there are 272 DICOM files in "dcm_dir_path"
-    assert len(dcm_list) == 272, f'There should be 272 DICOM files in {dcm_dir_path}.'
+    # Change orientation of every slice of volume (i.e. apply np.fliplr(np.rot90(...)) 
+    # to each slice, or to volume itself if it is a single 2D slice) and convert it to 
+    # int16 in a single pass, writing the result directly into the C-contiguous output 
+    # array (this strided copy is faster than gathering the voxels with a precomputed 
+    # index array and np.take)
+    np.copyto(out, np.flip(np.rot90(volume, axes=(-2, -1)), axis=-1), casting='unsafe')
 
-    # Specify index
-    idx = 100
+    # Return oriented volume
+    return out
 
-    # Load NIfTI GT segmentation file
-    gt_segs = nib.load(seg_path)
-    gt_segs = gt_segs.get_fdata()
+def get_cache_path(nii_path, cache_dir):
 
-    # Check shape of GT segmentation array
-    assert gt_segs.shape == (272, 512, 512), 'The shape of the array of the ground-truth segmentations should be (272, 512, 512).'
+    # Create key from absolute path, modification time and size of NIfTI file (so that 
+    # a modified NIfTI file, or a different NIfTI file with the same name, does not 
+    # use an out-of-date cache file)
+    nii_stat = nii_path.stat()
+    nii_key = hashlib.sha1(f'{nii_path.resolve()}:{nii_stat.st_mtime_ns}:{nii_stat.st_size}'.encode()).hexdigest()[:16]
 
-    # Check there are three segmentation classes
-    seg_val_list = np.unique(gt_segs)
-    assert len(seg_val_list) == 3, 'There are not three segmentation classes in the ground-truth segmentations.'
-    assert min(seg_val_list) == 0, 'One segmentation class should have a value of 0.'
-    assert max(seg_val_list) == 2, 'One segmentation class should have a value of 2.'
+    # Return path to cache file
+    return cache_dir / f'{nii_path.name}.{nii_key}.oriented.npy'
 
-    # Plot slice (i.e. 2D image) of GT segmentations
-    # plt.imshow(gt_segs[idx, ...])
-    # plt.axis('off')
+def load_cached_volume(nii_path, cache_dir):
+
+    # Check cache is enabled and cache file exists
+    if cache_dir is None:
+        return None
+    cache_path = get_cache_path(nii_path, cache_dir)
+    if not cache_path.exists():
+        return None
+
+    # Load oriented volume (memory-mapped, so only the slices that are used are read from disk)
+    volume = np.load(cache_path, mmap_mode='r')
+
+    # Check shape and data type of oriented volume
+    assert volume.shape == VOLUME_SHAPE and volume.dtype == np.int16, f'The cache file "{cache_path}" should contain an int16 array with a shape of {VOLUME_SHAPE}. Please delete it.'
+
+    # Return oriented volume
+    return volume
+
+def save_cached_volume(volume, nii_path, cache_dir):
+
+    # Check cache is enabled
+    if cache_dir is None:
+        return
+
+    # Save oriented volume to a uniquely named temporary file, then rename it (so that 
+    # an interrupted save, or another process saving the same volume at the same time, 
+    # does not leave an incomplete cache file)
+    cache_path = get_cache_path(nii_path, cache_dir)
+    with tempfile.NamedTemporaryFile(dir=cache_dir, delete=False, suffix='.tmp') as f:
+        np.save(f, volume)
+    os.replace(f.name, cache_path)
+
+def _inconsistent_slices(a, b, chunk_size=16):
+
+    # Treat a single 2D slice as a volume containing one slice
+    a = np.asarray(a).reshape(-1, *np.shape(a)[-2:])
+    b = np.asarray(b).reshape(-1, *np.shape(b)[-2:])
+
+    # For each chunk of slices (so that the temporary arrays are small)
+    inconsistent = np.empty(a.shape[0], dtype=bool)
+    for start in range(0, a.shape[0], chunk_size):
+
+        # Calculate difference between arrays (as int32, so that differences 
+        # between int16 or uint16 values cannot overflow)
+        diff = np.subtract(a[start:start + chunk_size], b[start:start + chunk_size], dtype=np.int32)
+
+        # Check, for each slice, whether the difference is not constant (a constant 
+        # difference is allowed because nibabel applies the NIfTI intercept and slope, 
+        # e.g. an offset of -1024, whereas pydicom returns the stored DICOM values)
+        inconsistent[start:start + chunk_size] = (diff != diff[:, :1, :1]).any(axis=(1, 2))
+
+    # Return array indicating which slices are inconsistent
+    return inconsistent
+
+def _same(a, b):
+
+    # Check arrays have the same shape and every slice differs by a constant
+    return a.shape == b.shape and not _inconsistent_slices(a, b).any()
+
+def _read_pixels(dcm_path):
+
+    # Load DICOM file and return image array
+    return pydicom.dcmread(dcm_path).pixel_array
+
+def _process_slice(args):
+
+    # Unpack arguments
+    dcm_path, save_dir_path, gt_seg_bytes = args
+
+    # If dicomsdl is installed, replace PixelData field (with VR set to OW, as in the 
+    # pydicom code below) and save modified DICOM file without parsing the DICOM 
+    # headers in Python (note that dicomsdl sets the Implementation Class UID, 
+    # Implementation Version Name and Source Application Entity Title fields of 
+    # the file meta information to its own values)
+    if HAVE_DICOMSDL:
+        dcm_file = dicomsdl.open(str(dcm_path))
+        dcm_file.removeDataElement('PixelData')
+        dcm_file.addDataElement('PixelData', dicomsdl.VR.OW).fromBytes(gt_seg_bytes)
+        dcm_file.saveToFile(str(save_dir_path / dcm_path.name))
+        return
+
+    # Load DICOM file headers only (the pixel data are replaced below)
+    dcm_file = pydicom.dcmread(dcm_path, stop_before_pixels=True)
+
+    # Add PixelData field
+    dcm_file.PixelData = gt_seg_bytes
+    dcm_file['PixelData'].VR = 'OW'
+
+    # Save modified DICOM file
+    dcm_file.save_as(save_dir_path / dcm_path.name)
+
+def main(seg_path, nii_img_path, dcm_dir_path, save_dir_path, num_workers=None, debug=False, cache_dir=None):
 
-    # Load NIfTI image file
-    nii_img = nib.load(nii_img_path)
-    nii_img = nii_img.get_fdata()
+    # Specify number of processes (if not specified)
+    if num_workers is None:
+        num_workers = os.cpu_count() or 1
+
+    # Import matplotlib (only required to plot images in debug mode)
+    if debug:
+        import matplotlib.pyplot as plt
+
+    # Create list of paths to DICOM files in "dcm_dir_path"
+    dcm_list = list_files_in_dir(dcm_dir_path)
+
+    # Check there are NUM_SLICES DICOM files in "dcm_dir_path"
+    assert len(dcm_list) == NUM_SLICES, f'There should be {NUM_SLICES} DICOM files in {dcm_dir_path}.'
+
+    # Specify index
+    idx = 100
+
+    # Load NIfTI image file (memory-mapped if it is uncompressed, so only the 
+    # slices that are indexed below are read from disk)
+    nii_img = nib.load(nii_img_path, mmap=True)
 
     # Check shape of image array
-    assert nii_img.shape == (272, 512, 512), 'The shape of the array of the image should be (272, 512, 512).'
+    assert nii_img.shape == VOLUME_SHAPE, f'The shape of the array of the image should be {VOLUME_SHAPE}.'
 
-    # Plot image slice
-    # plt.imshow(nii_img[idx, ...])
-    # plt.axis('off')
+    # Load oriented image from cache (if available)
+    nii_oriented = load_cached_volume(nii_img_path, cache_dir)
+
+    # If NIfTI image file is compressed (i.e. it cannot be memory-mapped and reading 
+    # any slice decompresses the file up to that slice), read whole image once
+    if nii_oriented is None and nii_img_path.suffix == '.gz':
+        nii_oriented = orient_volume(np.asanyarray(nii_img.dataobj))
+
+        # Save oriented image to cache (if enabled)
+        save_cached_volume(nii_oriented, nii_img_path, cache_dir)
 
     # Load DICOM file containing image
-    dcm_file = pydicom.dcmread(dcm_dir_path / dcm_list[idx])
+    dcm_file = pydicom.dcmread(dcm_list[idx])
+
+    # Extract DICOM image array
+    dcm_pix = dcm_file.pixel_array
 
     # Check shape of image array
-    assert dcm_file.pixel_array.shape == (512, 512), 'The shape of the array of the image should be (512, 512).'
+    assert dcm_pix.shape == SLICE_SHAPE, f'The shape of the array of the image should be {SLICE_SHAPE}.'
 
     # Plot DICOM image
-    # plt.imshow(dcm_file.pixel_array)
-    # plt.axis('off')
+    if debug:
+        plt.imshow(dcm_pix)
+        plt.axis('off')
+        plt.show()
 
-    # Change orientation of NIfTI image slice
-    nii_slice = np.fliplr(np.rot90(nii_img[idx, ...]))
+    # Read NIfTI image slice, change its orientation and convert it to int16 
+    # (unless the oriented image has already been loaded)
+    nii_slice = orient_volume(nii_img.dataobj[idx]) if nii_oriented is None else nii_oriented[idx]
 
     # Plot NIfTI image slice
-    # plt.imshow(nii_slice)
-    # plt.axis('off')
+    if debug:
+        plt.imshow(nii_slice)
+        plt.axis('off')
+        plt.show()
 
     # Check images are consistent
-    if len(np.unique(nii_slice - dcm_file.pixel_array.astype('float64'))) != 1:
+    if not _same(nii_slice, dcm_pix):
 
         # Update idx
         idx *= -1
         idx -= 1
 
-        # Change orientation of NIfTI image slice
-        nii_slice = np.fliplr(np.rot90(nii_img[idx, ...]))
+        # Read NIfTI image slice, change its orientation and convert it to int16
+        # (unless the oriented image has already been loaded)
+        nii_slice = orient_volume(nii_img.dataobj[idx]) if nii_oriented is None else nii_oriented[idx]
 
         # Plot NIfTI image slice
-        # plt.imshow(nii_slice)
-        # plt.axis('off')
+        if debug:
+            plt.imshow(nii_slice)
+            plt.axis('off')
+            plt.show()
 
         # Check images are consistent 
-        assert len(np.unique(nii_slice - dcm_file.pixel_array.astype('float64'))) == 1, 'There is an inconsistency in the images.'
+        assert _same(nii_slice, dcm_pix), 'There is an inconsistency in the images.'
 
         # Reverse list of DICOM image files
         dcm_list.reverse()
 
-    # For each DICOM file
-    for idx, dcm_name in enumerate(dcm_list):
+    # Load oriented GT segmentations from cache (if available; GT segmentations 
+    # are only cached after they have passed the checks below)
+    gt_oriented = load_cached_volume(seg_path, cache_dir)
+    if gt_oriented is None:
+
+        # Load NIfTI GT segmentation file (at its stored data type rather than as float64)
+        gt_segs = nib.load(seg_path, mmap=True)
+        gt_segs = np.asanyarray(gt_segs.dataobj)
+
+        # Check shape of GT segmentation array
+        assert gt_segs.shape == VOLUME_SHAPE, f'The shape of the array of the ground-truth segmentations should be {VOLUME_SHAPE}.'
+
+        # Check values of GT segmentations are between 0 and 2 (before they are converted 
+        # to uint8, which would wrap out-of-range values, e.g. 258 to 2)
+        assert gt_segs.min() >= 0 and gt_segs.max() <= 2, 'The values of the ground-truth segmentations should be between 0 and 2.'
+
+        # Convert GT segmentations to uint8 (the segmentation classes are 0, 1 and 2) and, 
+        # if they are not stored as integers, check no values were truncated (e.g. 1.7 to 1)
+        gt_u8 = gt_segs.astype(np.uint8, copy=False)
+        assert np.issubdtype(gt_segs.dtype, np.integer) or np.array_equal(gt_u8, gt_segs), 'The values of the ground-truth segmentations should be integers.'
+        gt_segs = gt_u8
+
+        # Check there are three segmentation classes with values of 0, 1 and 2 (np.bincount 
+        # finds the values present in a single pass, without the sort performed by np.unique, 
+        # and np.flatnonzero returns them in ascending order, so the first and last values 
+        # are the minimum and maximum)
+        seg_val_list = np.flatnonzero(np.bincount(gt_segs.ravel(), minlength=3))
+        assert seg_val_list.shape == (3,) and seg_val_list[0] == 0 and seg_val_list[-1] == 2, f'There should be three segmentation classes in the ground-truth segmentations, with values of 0, 1 and 2 (values found: {seg_val_list.tolist()}).'
 
-        # Load DICOM file
-        dcm_file = pydicom.dcmread(dcm_dir_path / dcm_name)
+        # Change orientation of GT segmentations and convert them to int16
+        gt_oriented = orient_volume(gt_segs)
 
-        # Extract corresponding slice from NIfTI image array
-        nii_slice = np.fliplr(np.rot90(nii_img[idx, ...])).astype('int16')
+        # Save oriented GT segmentations to cache (if enabled)
+        save_cached_volume(gt_oriented, seg_path, cache_dir)
 
-        # Check images are consistent
-        assert len(np.unique(nii_slice - dcm_file.pixel_array.astype('float64'))) == 1, f'Slice {idx + 1}: There are inconsistencies between the DICOM and NIfTI images.'
+    # Plot slice (i.e. 2D image) of GT segmentations
+    if debug:
+        plt.imshow(gt_oriented[idx])
+        plt.axis('off')
+        plt.show()
+
+    # Change orientation of image and convert it to int16 (unless the oriented image 
+    # has already been loaded; for an uncompressed NIfTI file, this is the only point 
+    # at which the whole image is read)
+    if nii_oriented is None:
+        nii_oriented = orient_volume(np.asanyarray(nii_img.dataobj))
+
+        # Save oriented image to cache (if enabled)
+        save_cached_volume(nii_oriented, nii_img_path, cache_dir)
+
+    with ProcessPoolExecutor(max_workers=num_workers) as executor:
+
+        # Load DICOM images in parallel and stack them into a single array
+        dcm_cube = np.stack(list(executor.map(_read_pixels, dcm_list, chunksize=8)))
+
+        # Check shape of DICOM image array
+        assert dcm_cube.shape == VOLUME_SHAPE, f'The shape of the array of the DICOM images should be {VOLUME_SHAPE}.'
+
+        # Check DICOM and NIfTI images are consistent before saving any files 
+        # (and report first inconsistent slice, if there is one)
+        inconsistent = _inconsistent_slices(dcm_cube, nii_oriented)
+        assert not inconsistent.any(), f'Slice {np.flatnonzero(inconsistent)[0] + 1}: There are inconsistencies between the DICOM and NIfTI images.'
+
+        # Create byte view of oriented GT segmentations (each slice is copied from 
+        # this view into its own bytes object when its DICOM file is queued below, 
+        # as the bytes are sent to another process)
+        gt_view = memoryview(gt_oriented).cast('B')
 
-        # Extract corresponding GT segmentations
-        gt_seg_slice = np.fliplr(np.rot90(gt_segs[idx, ...])).astype('int16')
+        # Modify and save DICOM files in parallel, keeping a rolling window of at most 
+        # two files per process queued (so that the processes always have a file to 
+        # read while others are being saved, and the bytes of each slice are only 
+        # created shortly before they are needed)
+        max_pending = 2 * num_workers
+        pending = deque()
+        for idx, dcm_path in enumerate(dcm_list):
 
-        # Change PixelData field
-        dcm_file.PixelData = gt_seg_slice.tobytes()
+            # Wait for oldest file to be saved (if window is full)
+            if len(pending) == max_pending:
+                pending.popleft().result()
 
-        # Save modified DICOM file
-        dcm_file.save_as(save_dir_path / dcm_name)
+            # Queue file
+            pending.append(executor.submit(_process_slice, (dcm_path, save_dir_path, bytes(gt_view[idx * SLICE_NBYTES:(idx + 1) * SLICE_NBYTES]))))
+
+        # Wait for remaining files to be saved
+        for future in pending:
+            future.result()
 
     # Print update
     print('Finished converting ground-truth segmentations from a NIfTI file to DICOM files.')
@@ -156,6 +375,23 @@ if __name__ == "__main__":
         type=Path,
         required=True
         )
+    parser.add_argument(
+        '--num_workers',
+        help='Number of processes used to convert the DICOM files (default: number of CPUs).',
+        type=int,
+        default=None
+        )
+    parser.add_argument(
+        '--cache_dir',
+        help='Path to folder in which the oriented NIfTI arrays are cached, so that the NIfTI files are only decompressed and reoriented once (default: no cache).',
+        type=Path,
+        default=None
+        )
+    parser.add_argument(
+        '--debug',
+        help='Plot the image slices used to check the orientation of the NIfTI files and a slice of the ground-truth segmentations.',
+        action='store_true'
+        )
 
     # Parse arguments
     args = parser.parse_args()
@@ -165,6 +401,7 @@ if __name__ == "__main__":
     assert os.path.exists(args.nii_img_path), 'Please specify the absolute path to the NIfTI image file using the --nii_img_path argument to "NII_to_DCM_Python.py".'
     assert os.path.exists(args.dcm_dir_path), 'Please specify the absolute path to the folder containing the DICOM image files (i.e. the files with the relevant headers) using the --dcm_dir_path argument to "NII_to_DCM_Python.py".'
     assert os.path.exists(args.save_dir_path), 'Please ensure the folder into which the DICOM ground-truth segmentation files will be saved (i.e the folder with the name and absolute path specified by the --save_dir_path argument to "NII_to_DCM_Python.py") exists.'
+    assert args.cache_dir is None or os.path.exists(args.cache_dir), 'Please ensure the folder in which the oriented NIfTI arrays will be cached (i.e. the folder specified by the --cache_dir argument to "NII_to_DCM_Python.py") exists.'
 
     # Run main function
-    main(args.nii_seg_path, args.nii_img_path, args.dcm_dir_path, args.save_dir_path)
+    main(args.nii_seg_path, args.nii_img_path, args.dcm_dir_path, args.save_dir_path, args.num_workers, args.debug, args.cache_dir)